@@ -2,13 +2,22 @@
 #
 # __ssmuse.py
 
+import errno
+import fnmatch
+import hashlib
+import json
 import os
-from os.path import basename, dirname, exists, isdir, realpath
+from os.path import basename, dirname
 from os.path import join as joinpath
+import Queue
+import select
+import signal
 import socket
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 class CodeGenerator:
@@ -19,6 +28,72 @@ class CodeGenerator:
     def __str__(self):
         return "".join(self.segs)
 
+    def exportpendpaths(self, pend, name, paths):
+        jpaths = ":".join(paths)
+        if pend == "prepend":
+            val = "%s:${%s}" % (jpaths, name)
+        elif pend == "append":
+            val = "${%s}:%s" % (name, jpaths)
+        self.exportpath(name, val, jpaths)
+
+    def loaditem(self, pathtype, pend, path, platforms=None):
+        pass
+
+class AnalyzeCodeGenerator(CodeGenerator):
+    """Pseudo code generator applying the changes to a copy of the
+    environment and reporting on the resulting search paths.
+    """
+
+    def __init__(self, asjson=False):
+        CodeGenerator.__init__(self)
+        self.asjson = asjson
+        self.env = dict(os.environ)
+        self.sources = []
+
+    def __str__(self):
+        report = analyzeenv(self.env)
+        report["sources"] = self.sources
+        if self.asjson:
+            return json.dumps(report, indent=2, sort_keys=True)+"\n"
+        return formatanalysis(report)
+
+    def comment(self, s):
+        pass
+
+    def deduppath(self, name):
+        pass
+
+    def echo2err(self, s):
+        pass
+
+    def echo2out(self, s):
+        pass
+
+    def execute(self, s):
+        pass
+
+    def exportpath(self, name, val, fallback):
+        if self.env.get(name):
+            self.env[name] = val.replace("${%s}" % (name,), self.env[name])
+        else:
+            self.env[name] = fallback
+
+    def exportliteral(self, name, val):
+        self.env[name] = val
+
+    def exportvar(self, name, val):
+        self.env[name] = val
+
+    def sourcefile(self, path):
+        # not run; listed in the report
+        self.sources.append(path)
+
+    def ssmuseonchangeddeps(self, args):
+        pass
+
+    def unexportvar(self, name):
+        self.env.pop(name, None)
+
 class CshCodeGenerator(CodeGenerator):
     """Code generator for csh-family of shells.
     """
@@ -57,6 +132,9 @@ else
     endif
 endif\n""" % (name, name, fallback, name, name, val, name, fallback))
 
+    def exportliteral(self, name, val):
+        self.segs.append("""setenv %s %s\n""" % (name, shquote(val)))
+
     def exportvar(self, name, val):
         self.segs.append("""setenv %s "%s"\n""" % (name, val))
 
@@ -78,6 +156,100 @@ fi
     def unexportvar(self, name):
         self.segs.append("""unsetenv %s\n""" % (name,))
 
+class JsonCodeGenerator(CodeGenerator):
+    """Code generator producing a json description of the changes,
+    for programs applying them without a shell.
+    """
+
+    def __init__(self):
+        CodeGenerator.__init__(self)
+        self.exports = {}
+        self.items = []
+        self.order = []
+        self.paths = {}
+        self.sources = []
+        self.unsets = []
+
+    def __str__(self):
+        variables = {}
+        for name in self.order:
+            d = self.paths[name]
+            variables[name] = {
+                "prepend": d["prepend"],
+                "append": d["append"],
+                # value if unset or empty
+                "fallback": ":".join(d["prepend"]+d["append"]),
+            }
+        doc = {
+            "platforms": platforms,
+            "depnames": dict([(name, os.environ.get(name, "")) for name in depnames]),
+            "items": self.items,
+            "paths": variables,
+            "paths_order": self.order,
+            "export": self.exports,
+            "unset": self.unsets,
+            "source": self.sources,
+        }
+        return json.dumps(doc, indent=2, sort_keys=True)+"\n"
+
+    def comment(self, s):
+        pass
+
+    def deduppath(self, name):
+        pass
+
+    def echo2err(self, s):
+        pass
+
+    def echo2out(self, s):
+        pass
+
+    def execute(self, s):
+        pass
+
+    def exportpath(self, name, val, fallback):
+        if val.startswith("${%s}:" % (name,)):
+            self.exportpendpaths("append", name, fallback.split(":"))
+        elif val.endswith(":${%s}" % (name,)):
+            self.exportpendpaths("prepend", name, fallback.split(":"))
+        else:
+            self.exportvar(name, fallback)
+
+    def exportpendpaths(self, pend, name, paths):
+        if name not in self.paths:
+            self.order.append(name)
+            self.paths[name] = {"prepend": [], "append": []}
+        if pend == "prepend":
+            self.paths[name]["prepend"][0:0] = paths
+        else:
+            self.paths[name]["append"].extend(paths)
+
+    def exportliteral(self, name, val):
+        self.exportvar(name, val)
+
+    def exportvar(self, name, val):
+        self.exports[name] = val
+        if name in self.unsets:
+            self.unsets.remove(name)
+
+    def loaditem(self, pathtype, pend, path, platforms=None):
+        d = {"type": pathtype, "pend": pend, "path": path}
+        if platforms != None:
+            d["platforms"] = platforms
+        self.items.append(d)
+
+    def sourcefile(self, path):
+        self.sources.append(path)
+
+    def ssmuseonchangeddeps(self, args):
+        # see depnames
+        pass
+
+    def unexportvar(self, name):
+        self.exports.pop(name, None)
+        if name not in self.unsets:
+            self.unsets.append(name)
+
 class ShCodeGenerator(CodeGenerator):
     """Code generator for sh-family of shells.
     """
@@ -113,6 +285,9 @@ else
     export %s="%s"
 fi\n""" % (name, name, val, name, fallback))
 
+    def exportliteral(self, name, val):
+        self.segs.append("""export %s=%s\n""" % (name, shquote(val)))
+
     def exportvar(self, name, val):
         self.segs.append("""export %s="%s"\n""" % (name, val))
 
@@ -135,10 +310,259 @@ fi
         self.segs.append("""unset %s\n""" % (name,))
 
 ##
+## memoised filesystem probes
 ##
+## Each path is lstat'ed, read (link) or listed at most once per
+## invocation. Symlinks are resolved component by component so that
+## common (deep, symlinked) prefixes are resolved only once.
 ##
 
-def getplatforms():
+def exists(path):
+    return getstat(path) != None
+
+def getstat(path):
+    """Memoised os.stat. None if path does not exist.
+    """
+    return lstat(realpath(path))
+
+def isdir(path):
+    st = getstat(path)
+    return st != None and S_ISDIR(st.st_mode)
+
+def listdir(path):
+    """Memoised os.listdir.
+    """
+    path = realpath(path)
+    try:
+        names = fscache["listdir"][path]
+    except KeyError:
+        try:
+            names = probe(os.listdir, path)
+        except OSError, e:
+            # unresponsive is treated as empty
+            names = e.errno == errno.ETIMEDOUT and [] or e
+        fscache["listdir"][path] = names
+    if isinstance(names, OSError):
+        raise names
+    return names[:]
+
+def lstat(path):
+    """Memoised os.lstat. None if path does not exist.
+    """
+    try:
+        return fscache["lstat"][path]
+    except KeyError:
+        try:
+            st = probe(os.lstat, path)
+        except OSError:
+            st = None
+        fscache["lstat"][path] = st
+        return st
+
+def readfile(path):
+    """Read a whole file within the probe deadline. IOError on
+    failure, including an unresponsive mount.
+    """
+    try:
+        return probe(__readfile, path)
+    except OSError, e:
+        raise IOError(e.errno, e.strerror, path)
+
+def __readfile(path):
+    f = open(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def readlink(path):
+    try:
+        return fscache["readlink"][path]
+    except KeyError:
+        target = fscache["readlink"][path] = probe(os.readlink, path)
+        return target
+
+def realpath(path):
+    """Memoised os.path.realpath.
+    """
+    if not path.startswith("/"):
+        path = joinpath(os.getcwd(), path)
+    return __resolvepath(path, 0)
+
+def __resolvepath(path, depth):
+    try:
+        return fscache["realpath"][path]
+    except KeyError:
+        pass
+    parent, name = os.path.split(path)
+    if parent == path:
+        return "/"
+    resolved = __resolvepath(parent, depth)
+    if name == "..":
+        resolved = dirname(resolved)
+    elif name not in ["", "."]:
+        resolved = joinpath(resolved, name)
+        st = lstat(resolved)
+        if st != None and S_ISLNK(st.st_mode) and depth < 40:
+            try:
+                # ".." in target applies to the resolved parent
+                target = joinpath(dirname(resolved), readlink(resolved))
+                resolved = __resolvepath(target, depth+1)
+            except OSError:
+                pass
+    fscache["realpath"][path] = resolved
+    return resolved
+
+fscache = {"listdir": {}, "lstat": {}, "readlink": {}, "realpath": {}}
+
+##
+## deadline-bounded probes
+##
+## Filesystem probes run in a worker thread so that a hung (NFS)
+## mount cannot block past $SSMUSE_PROBE_TIMEOUT seconds. A mount
+## that times out is treated as absent and remembered, for
+## $SSMUSE_PROBE_NEGTTL seconds, in the hung mounts cache.
+##
+
+class ProbeWorker:
+    """Worker thread running probes for one calling thread. Results
+    are signalled through a pipe so that the caller can wait with
+    select() (Python 2 timed lock waits poll).
+    """
+
+    def __init__(self):
+        self.requests = Queue.Queue()
+        self.result = None
+        self.rfd, self.wfd = os.pipe()
+        th = threading.Thread(target=self.run)
+        th.setDaemon(True)
+        th.start()
+
+    def run(self):
+        while True:
+            fn, path = self.requests.get()
+            try:
+                self.result = (fn(path), None)
+            except Exception, e:
+                self.result = (None, e)
+            try:
+                os.write(self.wfd, "x")
+            except OSError:
+                return
+
+    def call(self, fn, path, timeout):
+        """Return fn(path). Return None on timeout; the worker is
+        then stuck and must be abandoned.
+        """
+        self.requests.put((fn, path))
+        r, _, _ = select.select([self.rfd], [], [], timeout)
+        if not r:
+            return None
+        os.read(self.rfd, 1)
+        return self.result
+
+def gethungmounts():
+    """Load the unexpired hung mounts (path -> expiry time).
+    """
+    global hungmounts
+
+    if hungmounts == None:
+        hungmounts = {}
+        try:
+            now = time.time()
+            d = json.loads(readfile(joinpath(getcachedir("probes"), "hung")))
+            for path, expiry in d.items():
+                if expiry > now:
+                    hungmounts[path] = expiry
+        except:
+            pass
+    return hungmounts
+
+def getmountpoint(path):
+    """Return the mount point containing path, from the mount table
+    (no filesystem access), or path if that is "/".
+    """
+    global mountpoints
+
+    if mountpoints == None:
+        mountpoints = []
+        try:
+            for line in open("/proc/mounts"):
+                mountpoint = line.split()[1].replace("\\040", " ")
+                mountpoints.append(mountpoint)
+        except (IOError, IndexError):
+            pass
+    best = "/"
+    for mountpoint in mountpoints:
+        if (path == mountpoint or path.startswith(mountpoint.rstrip("/")+"/")) \
+            and len(mountpoint) > len(best):
+            best = mountpoint
+    if best == "/":
+        return path
+    return best
+
+def probe(fn, path):
+    """Run fn(path) within the probe deadline. Raise OSError
+    (ETIMEDOUT) for a hung, or known to be hung, mount.
+    """
+    if probetimeout <= 0:
+        return fn(path)
+
+    for mountpoint in gethungmounts():
+        if path == mountpoint or path.startswith(mountpoint+"/"):
+            if mountpoint not in hungwarned:
+                hungwarned.add(mountpoint)
+                printe("warning: skipping unresponsive mount (%s)" % (mountpoint,))
+            raise OSError(errno.ETIMEDOUT, "unresponsive mount (%s)" % (mountpoint,), path)
+
+    worker = getattr(probelocal, "worker", None)
+    if worker == None:
+        worker = probelocal.worker = ProbeWorker()
+    result = worker.call(fn, path, probetimeout)
+    if result == None:
+        probelocal.worker = None
+        mountpoint = getmountpoint(path)
+        printe("warning: probe timed out after %ss (%s); treating (%s) as absent" \
+            % (probetimeout, path, mountpoint))
+        hungwarned.add(mountpoint)
+        sethungmount(mountpoint)
+        raise OSError(errno.ETIMEDOUT, "probe timed out", path)
+    value, e = result
+    if e:
+        raise e
+    return value
+
+def sethungmount(mountpoint):
+    gethungmounts()[mountpoint] = time.time()+probenegttl
+    try:
+        writejsonfile(joinpath(getcachedir("probes"), "hung"), hungmounts)
+    except (IOError, OSError):
+        pass
+
+hungmounts = None
+hungwarned = set()
+mountpoints = None
+probelocal = threading.local()
+try:
+    probetimeout = float(os.environ.get("SSMUSE_PROBE_TIMEOUT", 10))
+    probenegttl = float(os.environ.get("SSMUSE_PROBE_NEGTTL", 60))
+except ValueError:
+    probetimeout, probenegttl = 10, 60
+
+##
+##
+##
+
+def getplatforms(target=None):
+    if target != None:
+        # the target and its compatible platforms, not the host's
+        env = dict(os.environ)
+        env.pop("FORCE_SSM_PLATFORM", None)
+        p = subprocess.Popen([joinpath(heredir, "ssmuse_platforms"), target],
+            stdout=subprocess.PIPE, env=env)
+        platforms, _ = p.communicate()
+        return filter(None, platforms.split())
+
     platforms = os.environ.get("SSMUSE_PLATFORMS")
     if platforms == None:
         if exists("/etc/ssm/platforms"):
@@ -157,13 +581,13 @@ def is_pkgpath(path):
 def isemptydir(path):
     if not isdir(path):
         return True
-    l = os.listdir(path)
+    l = listdir(path)
     return len(l) == 0
 
 def islibfreedir(path):
     if not isdir(path):
         return True
-    l = [name for name in os.listdir(path) if name.endswith(".a") or name.endswith(".so") or name.find(".so.") > 1]
+    l = [name for name in listdir(path) if name.endswith(".a") or name.endswith(".so") or name.find(".so.") > 1]
     return len(l) == 0
 
 def isnotemptydir(path):
@@ -194,24 +618,25 @@ VARS = [name for t in VARS_SETUPTABLE for name in t[0]]
 def __exportpendpath(pend, name, path):
     """No checks.
     """
-    if pend == "prepend":
-        val = "%s:${%s}" % (path, name)
-    elif pend == "append":
-        val = "${%s}:%s" % (name, path)
-    cg.exportpath(name, val, path)
+    cg.exportpendpaths(pend, name, [path])
+    envmodel.exportpendpaths(pend, name, [path])
 
 def __exportpendmpaths(pend, name, paths):
     """No checks.
     """
     if paths:
-        jpaths = ":".join(paths)
-        if pend == "prepend":
-            val = "%s:${%s}" % (jpaths, name)
-        elif pend == "append":
-            val = "${%s}:%s" % (name, jpaths)
-        cg.exportpath(name, val, jpaths)
+        cg.exportpendpaths(pend, name, paths)
+        envmodel.exportpendpaths(pend, name, paths)
 
 def augmentssmpath(pathtype, path):
+    """Memoised __augmentssmpath().
+    """
+    key = (pathtype, path)
+    if key not in resolvecache:
+        resolvecache[key] = __augmentssmpath(pathtype, path)
+    return resolvecache[key]
+
+def __augmentssmpath(pathtype, path):
     if path.startswith("/") \
         or path.startswith("./") \
         or path.startswith("../"):
@@ -259,6 +684,10 @@ def deduppaths():
     for name in VARS:
         cg.deduppath(name)
 
+def exportliteral(name, val):
+    cg.exportliteral(name, val)
+    envmodel.exportliteral(name, val)
+
 def exportpendlibpath(pend, name, path):
     if isdir(path) and not islibfreedir(path):
         __exportpendpath(pend, name, path)
@@ -273,7 +702,15 @@ def exportpendpath(pend, name, path):
     if isdir(path) and not isemptydir(path):
         __exportpendpath(pend, name, path)
 
+def exportvar(name, val):
+    cg.exportvar(name, val)
+    envmodel.exportvar(name, val)
+
 def exportpendpaths(pend, basepath):
+    if viewmembers != None:
+        addviewmember(pend, basepath)
+        return
+
     cg.echo2err("exportpendpaths: (%s) (%s)" % (pend, basepath))
 
     # table-driven
@@ -296,6 +733,65 @@ def exportpendpaths(pend, basepath):
         for varname in varnames:
             __exportpendmpaths(pend, varname, paths)
 
+def unexportvar(name):
+    cg.unexportvar(name)
+    envmodel.unexportvar(name)
+
+def getcachedir(*names):
+    """Return the (created as needed) cache directory for names.
+    """
+    path = os.environ.get("SSMUSE_CACHEDIR") or os.path.expanduser("~/.ssmuse/cache")
+    path = joinpath(path, *names)
+    # $HOME is often on NFS
+    if not probe(os.path.isdir, path):
+        try:
+            probe(os.makedirs, path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    return path
+
+def getcontrol(pkgpath):
+    """Return the (cached) fields of the package control file, or
+    {} if it is missing or unreadable.
+    """
+    path = joinpath(pkgpath, ".ssm.d/control")
+    if not exists(path):
+        return {}
+    try:
+        # cache failures fall back to parsecontrol() in loadcached()
+        return loadcached("control", path, parsecontrol)
+    except IOError:
+        return {}
+
+def getpkgdeps(pkgpath):
+    """Return the transitive dependencies of a package (from the
+    Depends field of the control files), each once, in dependency
+    order (dependencies before dependents), ending with pkgpath.
+    """
+    order = []
+    visiting = set()
+
+    def visit(pkgpath):
+        if pkgpath in order:
+            return
+        if pkgpath in visiting:
+            printe("warning: dependency cycle at (%s)" % (pkgpath,))
+            return
+        visiting.add(pkgpath)
+        depends = getcontrol(pkgpath).get("Depends", "")
+        for name in filter(None, [name.strip() for name in depends.split(",")]):
+            deppath = resolvepkgdep(pkgpath, name)
+            if deppath == None:
+                printe("warning: missing dependency (%s) of (%s)" % (name, pkgpath))
+            else:
+                visit(deppath)
+        visiting.remove(pkgpath)
+        order.append(pkgpath)
+
+    visit(pkgpath)
+    return order
+
 def getdepnames():
     depnames = []
     for _, _, xdirsname, _ in VARS_SETUPTABLE:
@@ -324,6 +820,76 @@ def matchpkgpath(pkgpath):
         return pkgpath
     return None
 
+def loadargs(args):
+    """Load the items given by args.
+    """
+    global followdeps, verbose, viewmembers
+
+    args = args[:]
+    while args:
+        arg = args.pop(0)
+        if arg in ["-d", "+d"] and args:
+            pend = arg[0] == "-" and "prepend" or "append"
+            _dompath = args.pop(0)
+            exportvar("SSMUSE_PENDMODE", pend)
+            _, dompath = augmentssmpath("domain", _dompath)
+            n = nsources
+            loaddomain(pend, dompath)
+            # only profiles can change depnames
+            if viewmembers == None and nsources != n:
+                cg.ssmuseonchangeddeps(args)
+        elif arg in ["-f", "+f"] and args:
+            pend = arg[0] == "-" and "prepend" or "append"
+            _dirpath = args.pop(0)
+            unexportvar("SSMUSE_PENDMODE")
+            _, dirpath = augmentssmpath("directory", _dirpath)
+            loaddirectory(pend, dirpath)
+        elif arg in ["-p", "+p"] and args:
+            pend = arg[0] == "-" and "prepend" or "append"
+            _pkgpath = args.pop(0)
+            exportvar("SSMUSE_PENDMODE", pend)
+            _, pkgpath = augmentssmpath("package", _pkgpath)
+            n = nsources
+            if followdeps:
+                loadpackagedeps(pend, pkgpath)
+            else:
+                loadpackage(pend, pkgpath)
+            if viewmembers == None and nsources != n:
+                cg.ssmuseonchangeddeps(args)
+        elif arg in ["-d@", "+d@", "-p@", "+p@"] and args:
+            pend = arg[0] == "-" and "prepend" or "append"
+            pathtype = arg[1] == "d" and "domain" or "package"
+            _itempath = args.pop(0)
+            _, itempath = augmentssmpath(pathtype, _itempath)
+            if not loadlazy(pend, pathtype, itempath):
+                # load it now instead
+                args = [arg[:2], _itempath]+args
+        elif arg in ["-x", "+x"] and args:
+            _xpath = args.pop(0)
+            pathtype, xpath = augmentssmpath(None, _xpath)
+            if pathtype == "directory":
+                args = [arg[0]+"f", _xpath]+args
+            elif pathtype == "domain":
+                args = [arg[0]+"d", _xpath]+args
+            elif pathtype == "package":
+                args = [arg[0]+"p", _xpath]+args
+        elif arg == "--append":
+            pend = "append"
+            cg.echo2err("pendmode: append")
+        elif arg == "--prepend":
+            pend = "prepend"
+            cg.echo2err("pendmode: prepend")
+        elif arg == "--nodeps":
+            followdeps = False
+        elif arg == "-v":
+            verbose = True
+        elif arg == "--view":
+            if viewmembers == None:
+                viewmembers = {"prepend": [], "append": []}
+        else:
+            printe("fatal: unknown argument (%s)" % (arg,))
+            sys.exit(1)
+
 def loaddomain(pend, dompath):
     _dompath = dompath
 
@@ -342,6 +908,7 @@ def loaddomain(pend, dompath):
             exportpendpaths(pend, platpath)
             loadprofiles(dompath, platform)
             loadedplatforms.append(platform)
+    cg.loaditem("domain", pend, dompath, loadedplatforms)
     if logger:
         log(dompath, "%s|loaddomain|%s|%s|%s|%s|%s|%s|%s|%s|%s" \
             % (nowst, os.environ.get("LOGNAME"), hostname, platform0,
@@ -358,15 +925,35 @@ def loadpackage(pend, pkgpath):
     cg.echo2err("loadpackage: (%s) (%s)" % (pend, pkgpath))
 
     pkgname = os.path.basename(pkgpath)
+    loadedpkgpaths.add(pkgpath)
+    cg.loaditem("package", pend, pkgpath)
     exportpendpaths(pend, pkgpath)
     path = joinpath(pkgpath, "etc/profile.d", pkgname+"."+shell)
     if exists(path):
-        cg.sourcefile(path)
+        sourcefile(path)
     if logger:
         log(pkgpath, "%s|loadpackage|%s|%s|%s|%s|%s|%s|%s" \
             % (nowst, os.environ.get("LOGNAME"), hostname,
                 platform0, shell, pend, _pkgpath, pkgpath))
 
+def loadpackagedeps(pend, pkgpath):
+    """Load a package after (prepend) or before (append) its
+    dependencies, which then have lower precedence. Dependencies
+    already loaded are skipped.
+    """
+    if pkgpath == None or not isdir(pkgpath):
+        loadpackage(pend, pkgpath)
+        return
+
+    pkgpaths = [path for path in getpkgdeps(pkgpath)[:-1] if path not in loadedpkgpaths]
+    if pkgpaths:
+        cg.echo2err("loadpackagedeps: (%s) (%s) (%s)" % (pend, pkgpath, " ".join(pkgpaths)))
+    pkgpaths.append(pkgpath)
+    if pend == "append":
+        pkgpaths.reverse()
+    for path in pkgpaths:
+        loadpackage(pend, path)
+
 def loaddirectory(pend, dirpath):
     _dirpath = dirpath
 
@@ -374,6 +961,7 @@ def loaddirectory(pend, dirpath):
         printe("loaddirectory: invalid directory (%s)" % (dirpath,))
         sys.exit(1)
 
+    cg.loaditem("directory", pend, dirpath)
     exportpendpaths(pend, dirpath)
     if logger:
         log(dirpath, "%s|loaddirectory|%s|%s|%s|%s|%s|%s|%s" \
@@ -386,11 +974,11 @@ def loadprofiles(dompath, platform):
     root = joinpath(dompath, platform, "etc/profile.d")
     if exists(root):
         suff = ".%s" % (shell,)
-        names = [name for name in os.listdir(root) if name.endswith(suff)]
+        names = [name for name in listdir(root) if name.endswith(suff)]
         for name in names:
             path = joinpath(root, name)
             if exists(path):
-                cg.sourcefile(path)
+                sourcefile(path)
 
 def log(path, message):
     if logger:
@@ -402,6 +990,32 @@ def log(path, message):
                 return
         logger.info(message)
 
+def parsecontrol(path):
+    """Parse a (debian-like) control file: "Name: value" lines;
+    lines starting with whitespace continue the previous value.
+    """
+    fields = {}
+    name = None
+    for line in readfile(path).splitlines():
+        if line[:1] in [" ", "\t"] and name:
+            fields[name] += "\n"+line.strip()
+        elif ":" in line:
+            name, value = line.split(":", 1)
+            name = name.strip()
+            fields[name] = value.strip()
+    return fields
+
+def resolvepkgdep(pkgpath, name):
+    """Resolve a dependency name (e.g., <name>_<version>, or a path)
+    first within the domain of the package, then as usual.
+    """
+    if not name.startswith("/"):
+        _, path = augmentssmpath("package", joinpath(dirname(pkgpath), name))
+        if path != None:
+            return path
+    _, path = augmentssmpath("package", name)
+    return path
+
 def resolvepcvar(s):
     """Resolve instances of %varname% in s as environment variables.
     """
@@ -414,6 +1028,62 @@ def resolvepcvar(s):
         l2.extend([v, l[i+1]])
     return "".join(l2)
 
+def sourcefile(path):
+    global nsources
+
+    nsources += 1
+    if viewmembers != None:
+        # profiles may rely on paths provided by the view
+        viewsources.append((path, envmodel.env.get("SSMUSE_PENDMODE")))
+    else:
+        __sourcefile(path)
+
+def __sourcefile(path):
+    """Source path, or replay its recorded delta if opted in.
+    """
+    delta = getprofiledelta(path)
+    if delta == None:
+        cg.sourcefile(path)
+        # its changes are unknown from here on
+        envmodel.sourcefile(path)
+    else:
+        cg.echo2err("profile delta: (%s)" % (path,))
+        loadprofiledelta(delta)
+
+def runparallel(fn, items, nworkers=8, timeout=None):
+    """Call fn for each of items using worker threads and return
+    the results (item -> result). Exceptions are returned as results.
+    With timeout (seconds), unfinished items are left out.
+    """
+    results = {}
+    q = Queue.Queue()
+    for item in items:
+        q.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[item] = fn(item)
+            except Exception, e:
+                results[item] = e
+
+    threads = [threading.Thread(target=worker) for _ in range(min(nworkers, q.qsize()))]
+    for th in threads:
+        th.setDaemon(timeout != None)
+        th.start()
+    if timeout != None:
+        deadline = time.time()+timeout
+    for th in threads:
+        if timeout == None:
+            th.join()
+        else:
+            th.join(max(0, deadline-time.time()))
+    return dict(results)
+
 def setuplogger():
     global logger, logpathprefixes
 
@@ -463,37 +1133,993 @@ def setuplogger():
             #traceback.print_exc()
             logger = None
 
+def loadcached(kind, path, parsefn):
+    """Return parsefn(path), cached under $SSMUSE_CACHEDIR/<kind>
+    and reused while the mtime and size of path are unchanged.
+    """
+    path = realpath(path)
+    st = getstat(path)
+    if st == None:
+        raise IOError(errno.ENOENT, "no such file", path)
+    key = [st.st_mtime, st.st_size]
+    cachepath = None
+    try:
+        # an unusable cache is a miss
+        cachepath = joinpath(getcachedir(kind), hashlib.sha1(path).hexdigest())
+        d = json.loads(readfile(cachepath))
+        if d["path"] == path and d["key"] == key:
+            return d["value"]
+    except:
+        pass
+    value = parsefn(path)
+    if cachepath != None:
+        try:
+            writejsonfile(cachepath, {"path": path, "key": key, "value": value})
+        except (IOError, OSError):
+            pass
+    return value
+
+def writejsonfile(path, obj):
+    """Write obj as json to path atomically (with respect to
+    concurrent invocations).
+    """
+    fd, tmpname = tempfile.mkstemp(prefix=basename(path), dir=dirname(path))
+    out = os.fdopen(fd, "w")
+    json.dump(obj, out)
+    out.close()
+    os.rename(tmpname, path)
+
+##
+## analysis
+##
+
+def analyzeenv(env):
+    """Report on the search path variables of env: size, duplicate
+    and missing entries, shadowed commands and libraries, and the
+    probe cost of a lookup.
+    """
+    varpaths = {}
+    for name in VARS:
+        varpaths[name] = [path for path in env.get(name, "").split(":") if path]
+    listings = scandirs([path for paths in varpaths.values() for path in paths])
+    # symlinked aliases (e.g., /bin -> /usr/bin) are the same directory
+    canon = dict([(path, realpath(path)) for path in listings])
+
+    variables = {}
+    for name in VARS:
+        paths = varpaths[name]
+        counts = {}
+        for path in paths:
+            counts[canon[path]] = counts.get(canon[path], 0)+1
+        duplicates = []
+        for path in paths:
+            if counts[canon[path]] > 1 and path not in duplicates:
+                duplicates.append(path)
+        variables[name] = {
+            "entries": len(paths),
+            "length": len(env.get(name, "")),
+            "duplicates": duplicates,
+            "missing": [path for path in paths if listings.get(path) == None],
+        }
+
+    shadowed = {}
+    cost = {}
+    for kind, name, testfn in [
+        ("commands", "PATH", iscommandpath),
+        ("libraries", "LD_LIBRARY_PATH", isshlibpath)]:
+        # entries are tested (stat) in the workers too
+        found, shadowed[kind] = findshadowed(varpaths[name],
+            scandirs(varpaths[name], testfn), canon)
+        nentries = len(varpaths[name])
+        cost[kind] = {
+            "miss": nentries,
+            "hit_mean": found and float(sum(found.values()))/len(found) or 0.0,
+            "hit_max": found and max(found.values()) or 0,
+            "names": len(found),
+        }
+    return {"variables": variables, "shadowed": shadowed, "cost": cost}
+
+def findshadowed(paths, listings, canon):
+    """Return the probe count (1-based index of the first providing
+    entry) for each name found in paths, and the shadowed names.
+    """
+    found = {}
+    providers = {}
+    seen = set()
+    for i, path in enumerate(paths):
+        if canon[path] in seen:
+            continue
+        seen.add(canon[path])
+        for name in listings.get(path) or []:
+            if name not in found:
+                found[name] = i+1
+                providers[name] = [path]
+            elif path not in providers[name]:
+                providers[name].append(path)
+    shadowed = [{"name": name, "used": l[0], "shadowed": l[1:]} \
+        for name, l in sorted(providers.items()) if len(l) > 1]
+    return found, shadowed
+
+def formatanalysis(report):
+    lines = []
+    for name in VARS:
+        d = report["variables"][name]
+        if not d["entries"]:
+            continue
+        lines.append("%s: %s entries, %s chars" % (name, d["entries"], d["length"]))
+        for path in d["duplicates"]:
+            lines.append("    duplicate: %s" % (path,))
+        for path in d["missing"]:
+            lines.append("    missing: %s" % (path,))
+    for kind in ["commands", "libraries"]:
+        l = report["shadowed"][kind]
+        lines.append("shadowed %s: %s" % (kind, len(l)))
+        for d in l:
+            lines.append("    %s: %s (shadows %s)" % (d["name"], d["used"], " ".join(d["shadowed"])))
+    for kind, what in [("commands", "command lookup (PATH)"), ("libraries", "library search (LD_LIBRARY_PATH)")]:
+        d = report["cost"][kind]
+        lines.append("%s: %s names, hit %.1f mean/%s max probes, miss %s probes" \
+            % (what, d["names"], d["hit_mean"], d["hit_max"], d["miss"]))
+    for path in report.get("sources", []):
+        lines.append("profile (not run): %s" % (path,))
+    return "\n".join(lines)+"\n"
+
+def iscommandpath(path):
+    """Executable regular file (as found by a PATH lookup).
+    """
+    st = getstat(path)
+    return st != None and S_ISREG(st.st_mode) and st.st_mode & 0111 != 0
+
+def isshlibpath(path):
+    name = basename(path)
+    return name.endswith(".so") or name.find(".so.") > 1
+
+def scandirs(paths, testfn=None, nworkers=8):
+    """List each unique directory once, using worker threads to
+    overlap (network) filesystem latency. With testfn, only entries
+    whose path passes it are listed. Missing directories map to
+    None.
+    """
+    def _listdir(path):
+        try:
+            names = listdir(path)
+        except OSError:
+            return None
+        if testfn:
+            names = [name for name in names if testfn(joinpath(path, name))]
+        return names
+
+    return runparallel(_listdir, set(paths), nworkers)
+
+##
+## manifests
+##
+
+def expandmanifests(args, depth=0):
+    """Replace @<path> and --manifest <path> arguments by the
+    arguments listed in the manifest files (recursively).
+    """
+    eargs = []
+    args = args[:]
+    while args:
+        arg = args.pop(0)
+        if arg in ITEM_OPTIONS and args:
+            eargs.extend([arg, args.pop(0)])
+        elif arg.startswith("@") or (arg == "--manifest" and args):
+            if arg == "--manifest":
+                path = args.pop(0)
+            else:
+                path = arg[1:]
+            if depth >= 16:
+                printe("fatal: manifests nested too deeply (%s)" % (path,))
+                sys.exit(1)
+            try:
+                margs = loadcached("manifests", path, parsemanifest)
+            except (IOError, OSError):
+                printe("fatal: cannot read manifest (%s)" % (path,))
+                sys.exit(1)
+            eargs.extend(expandmanifests(margs, depth+1))
+        else:
+            eargs.append(arg)
+    return eargs
+
+def parsemanifest(path):
+    """Return the arguments in a manifest file: the usual options
+    (e.g., -d <dompath>), whitespace separated, on any number of
+    lines. Text following # is ignored. Relative nested manifests
+    are relative to the manifest directory.
+    """
+    import shlex
+
+    mdir = dirname(path)
+    args = shlex.split(readfile(path), comments=True)
+    for i, arg in enumerate(args):
+        if arg.startswith("@") and not arg.startswith("@/"):
+            args[i] = "@"+joinpath(mdir, arg[1:])
+        elif i > 0 and args[i-1] == "--manifest" and not arg.startswith("/"):
+            args[i] = joinpath(mdir, arg)
+    return args
+
+def prefetchitems(args):
+    """Resolve all items of args in parallel, filling the
+    augmentssmpath() and probe caches for the main (serial) pass.
+    """
+    keys = []
+    for i, arg in enumerate(args[:-1]):
+        if arg in ITEM_OPTIONS:
+            pathtype = ITEM_PATHTYPES.get(arg[1])
+            keys.append((pathtype, args[i+1]))
+    if len(keys) > 1:
+        runparallel(lambda key: augmentssmpath(*key), set(keys))
+
+ITEM_OPTIONS = ["-d", "+d", "-f", "+f", "-p", "+p", "-x", "+x",
+    "-d@", "+d@", "-p@", "+p@"]
+ITEM_PATHTYPES = {"d": "domain", "f": "directory", "p": "package", "x": None}
+
+##
+## recorded profiles
+##
+## Opted-in profile scripts are run once, in a subshell, and the
+## resulting changes to the environment (delta) are recorded. Later
+## loads replay the delta instead of sourcing the script. Scripts are
+## run in the environment the generated code has at that point (see
+## envmodel); deltas are keyed by the script path and content,
+## platform, shell, and the search path and input variables of that
+## environment.
+##
+
+def diffenv(before, after):
+    """Return the delta from before to after, or None if it cannot
+    be replayed safely.
+    """
+    delta = []
+    for name in sorted(set(before.keys()+after.keys())):
+        if name in DELTA_IGNORE or before.get(name) == after.get(name):
+            continue
+        if name not in after:
+            delta.append(["unset", name])
+            continue
+        old, new = before.get(name, ""), after[name]
+        if "\n" in new:
+            return None
+        i = (":"+new+":").find(":"+old+":")
+        if old and i != -1:
+            # paths added around the previous value
+            prepaths = filter(None, new[:i].split(":"))
+            postpaths = filter(None, new[i+len(old):].split(":"))
+            for path in prepaths+postpaths:
+                if [c for c in "\"$`\\" if c in path]:
+                    return None
+            if prepaths:
+                delta.append(["prepend", name, prepaths])
+            if postpaths:
+                delta.append(["append", name, postpaths])
+        else:
+            delta.append(["set", name, new])
+    return delta
+
+def getprofiledelta(path):
+    """Return the recorded delta for an opted-in profile script
+    (recording it if needed), or None.
+    """
+    patterns = os.environ.get("SSMUSE_RECORD_PROFILES")
+    if patterns == None or targetplatform != None or analyzing:
+        # recordings are made on, and valid for, this host; analyze
+        # runs nothing
+        return None
+    patterns = filter(None, patterns.split(":"))
+    if "marked" not in patterns \
+        and not [pattern for pattern in patterns if matchprofile(path, pattern)]:
+        return None
+    try:
+        text = readfile(path)
+    except IOError:
+        return None
+    inputs = getrecordinputs(path, text, patterns)
+    if inputs == None:
+        return None
+    if envmodel.sources:
+        # the environment depends on scripts that were sourced
+        cg.echo2err("profile delta: unknown environment (%s)" % (path,))
+        return None
+
+    env = envmodel.env
+    key = [path, hashlib.sha1(text).hexdigest(), platform0, shell]
+    names = VARS+["SSMUSE_PENDMODE"]+inputs
+    key.extend(["%s=%s" % (name, env.get(name, "")) for name in sorted(set(names))])
+    try:
+        cachedir = getcachedir("profiles")
+    except (IOError, OSError):
+        # recording every time would cost more than sourcing
+        cg.echo2err("profile delta: no cache (%s)" % (path,))
+        return None
+    cachepath = joinpath(cachedir, hashlib.sha1("\n".join(key)).hexdigest())
+    try:
+        d = json.loads(readfile(cachepath))
+        if d["key"] == key:
+            return d["delta"]
+    except:
+        pass
+
+    cg.echo2err("profile delta: recording (%s)" % (path,))
+    delta = recordprofile(path, env)
+    if delta != None:
+        try:
+            writejsonfile(cachepath, {"key": key, "path": path, "delta": delta})
+        except (IOError, OSError):
+            pass
+    return delta
+
+def getrecordinputs(path, text, patterns):
+    """Return the input variable names of an opted-in profile
+    script, or None if it is not opted in.
+    """
+    inputs = filter(None, os.environ.get("SSMUSE_RECORD_INPUTS", "").split(":"))
+    markers = [line for line in text.splitlines() if line.startswith(RECORD_MARKER)]
+    if markers:
+        for word in markers[0][len(RECORD_MARKER):].split():
+            if word.startswith("inputs="):
+                inputs.extend(filter(None, word[7:].split(",")))
+    for pattern in patterns:
+        if (pattern == "marked" and markers) or matchprofile(path, pattern):
+            return inputs
+    return None
+
+def loadprofiledelta(delta):
+    for op in delta:
+        if op[0] == "unset":
+            unexportvar(op[1])
+        elif op[0] == "set":
+            exportliteral(op[1], op[2])
+        else:
+            __exportpendmpaths(op[0], op[1], op[2])
+
+def matchprofile(path, pattern):
+    return pattern != "marked" \
+        and (fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(basename(path), pattern))
+
+def recordprofile(path, env):
+    """Run the profile script in a subshell, in env, and return its
+    delta, or None on failure.
+    """
+    dumpenv = "exec %s -c '%s'" % (sys.executable, DUMPENV_CODE)
+    if shell == "csh":
+        argv = ["csh", "-f", "-c"]
+        cmd = "source %s >& /dev/null && %s" % (shquote(path), dumpenv)
+    else:
+        # as sourced by ssmuse-sh and login shells
+        argv = ["bash", "-c"]
+        cmd = ". %s </dev/null >/dev/null 2>&1 && %s" % (shquote(path), dumpenv)
+    try:
+        envs = []
+        for cmd in [cmd, dumpenv]:
+            p = subprocess.Popen(argv+[cmd], stdin=open(os.devnull), stdout=subprocess.PIPE, env=env)
+            out, _ = p.communicate()
+            if p.returncode != 0:
+                raise Exception()
+            envs.append(json.loads(out))
+    except:
+        printe("warning: could not record profile (%s)" % (path,))
+        return None
+    after, before = envs
+    return diffenv(before, after)
+
+DELTA_IGNORE = ["OLDPWD", "PWD", "SHLVL", "_"]
+DUMPENV_CODE = "import json, os, sys; sys.stdout.write(json.dumps(dict(os.environ)))"
+RECORD_MARKER = "# ssmuse: record"
+
+##
+## lazy loading
+##
+
+def buildshims(pend, pathtype, path, binpaths):
+    """Build, or update, the shim directory for an item and return
+    its path. binpaths are ordered from highest to lowest precedence.
+    """
+    key = hashlib.sha1("\n".join([pend, pathtype, path])).hexdigest()[:16]
+    shimpath = getcachedir("shims", platform0 or "none", key)
+    statepath = joinpath(shimpath, SHIMS_STATENAME)
+    signature = [[binpath, getattr(getstat(binpath), "st_mtime", None)] for binpath in binpaths]
+
+    try:
+        state = json.loads(readfile(statepath))
+        if state.get("signature") == signature:
+            cg.echo2err("buildshims: cached (%s)" % (shimpath,))
+            return shimpath
+    except:
+        pass
+
+    cg.echo2err("buildshims: building (%s)" % (shimpath,))
+    targets = {}
+    for binpath in binpaths:
+        if not isdir(binpath):
+            continue
+        for name in listdir(binpath):
+            target = joinpath(binpath, name)
+            st = getstat(target)
+            if name not in targets and st != None \
+                and not S_ISDIR(st.st_mode) and st.st_mode & 0111:
+                targets[name] = target
+
+    # also drops the cached load script (SHIMS_LOADNAME)
+    for name in os.listdir(shimpath):
+        if name not in targets and name != SHIMS_STATENAME:
+            os.remove(joinpath(shimpath, name))
+    pendflag = pend == "prepend" and "-" or "+"
+    pendflag += pathtype == "domain" and "d" or "p"
+    for name, target in targets.items():
+        shimfile = joinpath(shimpath, name)
+        out = open(shimfile+".tmp", "w")
+        out.write(SHIM_TEMPLATE % {
+            "heredir": heredir,
+            "item": shquote(path),
+            "loadpath": shquote(joinpath(shimpath, SHIMS_LOADNAME)),
+            "name": shquote(name),
+            "pendflag": pendflag,
+            "shimpath": shimpath,
+            "target": shquote(target),
+        })
+        out.close()
+        os.chmod(shimfile+".tmp", 0755)
+        os.rename(shimfile+".tmp", shimfile)
+
+    writejsonfile(statepath, {"item": path, "signature": signature,
+        "names": sorted(targets.keys())})
+    return shimpath
+
+def loadlazy(pend, pathtype, path):
+    """Add a shim directory with stubs for the executables of a
+    domain or package. The item is really loaded, for the command
+    only, the first time a stub is run. Return False, with nothing
+    loaded, if the shims cannot be built.
+    """
+    _path = path
+
+    if path == None or not isdir(path):
+        printe("loadlazy: invalid %s (%s)" % (pathtype, path))
+        sys.exit(1)
+
+    cg.echo2err("loadlazy: (%s) (%s) (%s)" % (pend, pathtype, path))
+
+    if pathtype == "domain":
+        # better platforms first
+        binpaths = [joinpath(path, platform, "bin") for platform in platforms]
+    else:
+        binpaths = [joinpath(path, "bin")]
+    try:
+        shimpath = buildshims(pend, pathtype, path, binpaths)
+    except (IOError, OSError), e:
+        printe("warning: could not build shims (%s)" % (e,))
+        return False
+    cg.loaditem("lazy"+pathtype, pend, path)
+    __exportpendpath(pend, "PATH", shimpath)
+    if logger:
+        log(path, "%s|loadlazy|%s|%s|%s|%s|%s|%s|%s|%s" \
+            % (nowst, os.environ.get("LOGNAME"), hostname,
+                platform0, shell, pend, pathtype, _path, path))
+    return True
+
+def shquote(s):
+    return "'%s'" % (s.replace("'", "'\\''"),)
+
+SHIMS_LOADNAME = ".ssmuse-load.sh"
+SHIMS_STATENAME = ".ssmuse-shims"
+SHIM_TEMPLATE = """#! /bin/bash
+#
+# ssmuse lazy loading stub
+
+__path=":${PATH}:"
+__path="${__path//":%(shimpath)s:"/:}"
+__path="${__path#:}"
+export PATH="${__path%%:}:%(heredir)s"
+unset __path
+# load code is generated once per shim directory (build); profiles
+# are sourced, not replayed, as it is reused across environments
+__load=%(loadpath)s
+if [ ! -r "${__load}" ]; then
+	(unset SSMUSE_RECORD_PROFILES; "%(heredir)s/__ssmuse" sh %(pendflag)s %(item)s) \\
+		> "${__load}.$$" 2>/dev/null \\
+		&& mv -f "${__load}.$$" "${__load}" || rm -f "${__load}.$$"
+fi
+if [ -r "${__load}" ]; then
+	. "${__load}"
+else
+	. "%(heredir)s/ssmuse-sh" %(pendflag)s %(item)s
+fi
+unset __load
+exec -a %(name)s %(target)s "$@"
+"""
+
+##
+## prewarm
+##
+
+def getusagetargets(path, top):
+    """Return the most often loaded items, on this platform, from
+    an ssmuse (file) log, as load arguments.
+    """
+    counts = {}
+    for line in readfile(path).splitlines():
+        fields = line.strip().split("|")
+        if len(fields) < 9 or fields[4] != str(platform0):
+            continue
+        kind, itempath = fields[1], fields[-1]
+        if kind == "loaddomain":
+            opt = "d"
+        elif kind == "loadpackage":
+            opt = "p"
+        elif kind == "loaddirectory":
+            opt = "f"
+        elif kind == "loadlazy":
+            opt = fields[-3][0]+"@"
+        else:
+            continue
+        pend = kind == "loadlazy" and fields[-4] or fields[-3]
+        key = ((pend == "append" and "+" or "-")+opt, itempath)
+        counts[key] = counts.get(key, 0)+1
+    keys = sorted(counts.keys(), key=lambda key: -counts[key])[:top]
+    return [arg for key in keys for arg in key]
+
+def prewarm(args):
+    """Resolve and load targets in parallel, within a time budget,
+    to populate the persistent caches (manifests, views, shims,
+    recorded profiles) and the filesystem caches of the host.
+    """
+    budget = 60.0
+    njobs = 8
+    top = 100
+    targets = []
+    while args:
+        arg = args.pop(0)
+        if arg == "--budget" and args:
+            budget = float(args.pop(0))
+        elif arg == "--jobs" and args:
+            njobs = int(args.pop(0))
+        elif arg == "--top" and args:
+            top = int(args.pop(0))
+        elif arg == "--from-log":
+            try:
+                targets.extend(getusagetargets(os.path.expanduser("~/.ssmuse/log"), top))
+            except IOError:
+                printe("warning: cannot read usage log")
+        elif arg in ITEM_OPTIONS+["--view", "-v"] \
+            or arg.startswith("@") or arg == "--manifest":
+            targets.append(arg)
+            if arg in ITEM_OPTIONS+["--manifest"] and args:
+                targets.append(args.pop(0))
+        else:
+            # bare name
+            targets.extend(["-x", arg])
+
+    t0 = time.time()
+    targets = expandmanifests(targets)
+    items = []
+    for i, arg in enumerate(targets[:-1]):
+        if arg in ITEM_OPTIONS and (arg, targets[i+1]) not in items:
+            items.append((arg, targets[i+1]))
+    results = runparallel(prewarmitem, items, njobs, budget-(time.time()-t0))
+
+    counts = {"warmed": 0, "invalid": 0, "timeout": 0}
+    invalid = []
+    for item in items:
+        status, elapsed = results.get(item, ("timeout", None))
+        if isinstance(status, Exception):
+            status, elapsed = "invalid", None
+        if status == "invalid":
+            invalid.append(item)
+        counts[status] += 1
+        print "%-8s %6s  %s" % (status, elapsed != None and "%.2fs" % (elapsed,) or "-", " ".join(item))
+    viewstatus = None
+    if "--view" in targets and not counts["timeout"]:
+        # the view depends on the whole, ordered, list
+        vargs = []
+        while targets:
+            arg = targets.pop(0)
+            if arg in ITEM_OPTIONS and targets:
+                item = (arg, targets.pop(0))
+                if item not in invalid:
+                    vargs.extend(item)
+            else:
+                vargs.append(arg)
+        vargs = tuple(vargs)
+        results = runparallel(prewarmview, [vargs], 1, budget-(time.time()-t0))
+        viewstatus, elapsed = results.get(vargs, ("timeout", None))
+        if isinstance(viewstatus, Exception):
+            viewstatus, elapsed = "invalid", None
+        print "%-8s %6s  %s" % (viewstatus, elapsed != None and "%.2fs" % (elapsed,) or "-", "view")
+    print "prewarm: %s targets, %s warmed, %s invalid, %s timed out in %.2fs (budget %ss)" \
+        % (len(items), counts["warmed"], counts["invalid"], counts["timeout"],
+            time.time()-t0, budget)
+    sys.stdout.flush()
+    # do not wait for stuck workers or leave loads running
+    for p in prewarmprocs:
+        if p.poll() == None:
+            try:
+                # with any profile recordings it runs
+                os.killpg(p.pid, signal.SIGKILL)
+            except OSError:
+                pass
+    os._exit(int(counts["warmed"] != len(items) or viewstatus not in [None, "warmed"]))
+
+def prewarmitem(item):
+    t0 = time.time()
+    if augmentssmpath(ITEM_PATHTYPES[item[0][1]], item[1])[1] == None:
+        return "invalid", time.time()-t0
+    return prewarmrun(list(item)), time.time()-t0
+
+def prewarmrun(args):
+    """Load args in a separate ssmuse process, discarding the code,
+    and return the status. Each target gets its own state (loaded
+    packages, environment model, view members) as in a real load.
+    """
+    argv = [sys.executable, sys.argv[0], shell]
+    if targetplatform != None:
+        argv.extend(["--platform", targetplatform])
+    env = dict(os.environ)
+    # prewarm must not count as usage
+    env.pop("SSMUSE_LOG", None)
+    devnull = open(os.devnull, "r+")
+    p = subprocess.Popen(argv+args, stdin=devnull, stdout=devnull, stderr=devnull, env=env,
+        preexec_fn=os.setpgrp)
+    prewarmprocs.append(p)
+    p.wait()
+    return p.returncode == 0 and "warmed" or "invalid"
+
+def prewarmview(vargs):
+    t0 = time.time()
+    status = prewarmrun(list(vargs))
+    return status, status == "warmed" and time.time()-t0 or None
+
+##
+## views
+##
+
+def addviewmember(pend, basepath):
+    """Record basepath as a member of the prepend or append view.
+    Members are kept ordered from highest to lowest precedence, as
+    they would be found in the search paths.
+    """
+    for members in viewmembers.values():
+        if basepath in members:
+            members.remove(basepath)
+    if pend == "prepend":
+        viewmembers[pend].insert(0, basepath)
+    else:
+        viewmembers[pend].append(basepath)
+
+def applyviewmapping(viewpath, mapping):
+    """Update the view tree to match mapping. Only entries that
+    differ are touched.
+    """
+    if os.path.isdir(viewpath):
+        for dirpath, dirnames, filenames in os.walk(viewpath, topdown=False):
+            for name in dirnames+filenames:
+                path = joinpath(dirpath, name)
+                rel = path[len(viewpath)+1:]
+                if rel == VIEW_STATENAME:
+                    continue
+                target = mapping.get(rel, False)
+                if os.path.islink(path):
+                    if not target or os.readlink(path) != target:
+                        os.remove(path)
+                elif os.path.isdir(path):
+                    if target != None:
+                        os.rmdir(path)
+                else:
+                    os.remove(path)
+
+    for rel in sorted(mapping.keys()):
+        path = joinpath(viewpath, rel)
+        target = mapping[rel]
+        try:
+            if target == None:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif not os.path.islink(path):
+                os.symlink(target, path)
+        except OSError, e:
+            # concurrent builder
+            if e.errno != errno.EEXIST:
+                raise
+
+def buildview(members):
+    """Build, or incrementally update, the view for members and
+    return its path.
+    """
+    reldirs = getviewreldirs()
+    # views differing in reldirs (SSMUSE_XINCDIRS, ...) must not share a tree
+    key = hashlib.sha1("\n".join([platform0 or ""]+members+[""]+reldirs)).hexdigest()[:16]
+    viewpath = joinpath(getcachedir("views", platform0 or "none"), key)
+    statepath = joinpath(viewpath, VIEW_STATENAME)
+    signature = getviewsignature(members, reldirs)
+
+    try:
+        state = json.loads(readfile(statepath))
+        merged = state.get("merged", [])
+        if state.get("reldirs") == reldirs and state.get("signature") == signature \
+            and getviewmtimes([path for path, _ in merged]) == merged:
+            cg.echo2err("buildview: cached (%s)" % (viewpath,))
+            return viewpath
+    except:
+        pass
+
+    cg.echo2err("buildview: building (%s)" % (viewpath,))
+    mapping, conflicts = getviewmapping(members, reldirs)
+    applyviewmapping(viewpath, mapping)
+    for rel, winner, loser in conflicts:
+        printe("warning: view conflict (%s) using (%s) over (%s)" % (rel, winner, loser))
+
+    merged = getviewmtimes(getviewmerged(members, reldirs, mapping))
+    writejsonfile(statepath, {"members": members, "reldirs": reldirs,
+        "signature": signature, "merged": merged, "conflicts": conflicts})
+    return viewpath
+
+def getviewmapping(members, reldirs):
+    """Map view-relative paths to symlink targets (None for a real
+    directory). Earlier members win; colliding directories are
+    merged, colliding files are reported as conflicts.
+    """
+    mapping = {}
+    conflicts = []
+    for reldir in reldirs:
+        while reldir and reldir not in mapping:
+            mapping[reldir] = None
+            reldir = dirname(reldir)
+    for reldir in reldirs:
+        for member in members:
+            mergeviewdir(mapping, conflicts, reldirs, reldir, joinpath(member, reldir))
+    return mapping, conflicts
+
+def getviewmerged(members, reldirs, mapping):
+    """Member directories merged into nested real directories of
+    the view (below the reldirs, which getviewsignature() covers).
+    """
+    paths = []
+    for rel in sorted(mapping.keys()):
+        if mapping[rel] != None \
+            or [reldir for reldir in reldirs if (reldir+"/").startswith(rel+"/")]:
+            continue
+        for member in members:
+            path = joinpath(member, rel)
+            if isdir(path):
+                paths.append(path)
+    return paths
+
+def getviewmtimes(paths):
+    """Modification times, as [path, mtime] (None if missing).
+    """
+    l = []
+    for path in paths:
+        st = getstat(path)
+        l.append([path, st != None and st.st_mtime or None])
+    return l
+
+def getviewreldirs():
+    """Directories, relative to a base path, used by
+    exportpendpaths(). These are real directories in a view.
+    """
+    reldirs = []
+    for _, basenames, xdirsname, _ in VARS_SETUPTABLE:
+        if xdirsname:
+            xdirnames = resolvepcvar(os.environ.get(xdirsname, "")).split(":")
+            xdirnames = filter(None, xdirnames)
+        else:
+            xdirnames = []
+        for basename in basenames:
+            for name in [basename]+xdirnames:
+                if name.startswith("/"):
+                    reldir = name[1:]
+                else:
+                    reldir = joinpath(basename[1:], name)
+                if reldir not in reldirs:
+                    reldirs.append(reldir)
+    return reldirs
+
+def getviewsignature(members, reldirs):
+    """Modification times of all member directories feeding the
+    view. A change to any of them triggers an update.
+    """
+    signature = []
+    for member in members:
+        mtimes = []
+        for reldir in reldirs:
+            try:
+                mtimes.append(getstat(joinpath(member, reldir)).st_mtime)
+            except AttributeError:
+                mtimes.append(None)
+        signature.append([member, mtimes])
+    return signature
+
+def loadview():
+    """Build the views (prepend and append) from the collected
+    members, export their paths and source the deferred profiles.
+    """
+    global viewmembers
+
+    d, viewmembers = viewmembers, None
+    if d == None:
+        return
+    for pend in ["prepend", "append"]:
+        members = d[pend]
+        if not members:
+            continue
+        cg.echo2err("loadview: (%s) (%s)" % (pend, " ".join(members)))
+        try:
+            viewpath = buildview(members)
+        except (IOError, OSError), e:
+            # fall back to regular loading
+            printe("warning: could not build view (%s)" % (e,))
+            if pend == "prepend":
+                members = reversed(members)
+            for member in members:
+                exportpendpaths(pend, member)
+        else:
+            exportpendpaths(pend, viewpath)
+    for path, pendmode in viewsources:
+        # as when the item was loaded
+        if pendmode != None:
+            exportvar("SSMUSE_PENDMODE", pendmode)
+        else:
+            unexportvar("SSMUSE_PENDMODE")
+        __sourcefile(path)
+
+def mergeviewdir(mapping, conflicts, reldirs, reldir, srcdir):
+    if not isdir(srcdir):
+        return
+    for name in sorted(listdir(srcdir)):
+        rel = joinpath(reldir, name)
+        src = joinpath(srcdir, name)
+        if rel in reldirs:
+            # handled on its own
+            continue
+        target = mapping.get(rel)
+        if rel not in mapping:
+            mapping[rel] = src
+        elif target == src:
+            continue
+        elif target == None:
+            if isdir(src):
+                mergeviewdir(mapping, conflicts, reldirs, rel, src)
+            else:
+                conflicts.append((rel, "(merged directory)", src))
+        elif isdir(target) and isdir(src):
+            # unfold into a real directory
+            mapping[rel] = None
+            mergeviewdir(mapping, conflicts, reldirs, rel, target)
+            mergeviewdir(mapping, conflicts, reldirs, rel, src)
+        else:
+            conflicts.append((rel, target, src))
+
+VIEW_STATENAME = ".ssmuse-view"
+
 HELP = """\
-usage: ssmuse-sh [options]
-       ssmuse-csh [options]
+usage: ssmuse-sh [--platform <platform>] [options]
+       ssmuse-csh [--platform <platform>] [options]
+       ssmuse analyze [--json] [options]
+       ssmuse json [options]
+       ssmuse prewarm [--shell sh|csh] [--budget <secs>] [--jobs <n>]
+              [--from-log [--top <n>]] [options|<name> ...]
 
 Load domains, packages, and generic/non-SSM directory tree. This
 program should be sourced for the results to be incorporated into
 the current shell.
 
+With analyze, nothing is loaded. Instead, the search path variables
+that would result are reported on: entry count, length, duplicate
+and missing directories, shadowed commands and shared libraries, and
+the number of probes for a command lookup and a library search.
+Profile scripts are listed but not run.
+
+With json, the changes are printed as a json document instead of
+shell code: per path variable, the prepended and appended paths and
+the value to use if it is unset or empty (fallback); the exported and
+unset variables; the (sh) profile scripts to source; and the loaded
+items. Results are valid while the depnames variables keep the given
+values.
+
+With prewarm, the targets (items as options, manifests, or bare names
+as with -x) are resolved and loaded in parallel, each by its own
+ssmuse process, within a time budget (default 60s), and the generated
+code is discarded. This populates
+the ssmuse caches (manifests, views, shims, recorded profiles) and the
+filesystem caches of the host; e.g., from cron or a boot hook. With
+--from-log, the (top) most often loaded items on this platform, from
+the ~/.ssmuse/log usage log, are added. What was warmed is reported.
+
 Options:
 -d|+d <dompath>
         Load domain.
+-d@|+d@ <dompath>
+        Load domain lazily: only a directory of stubs for its
+        executables is added to PATH. When a stub is run, the
+        domain is loaded (for that command) and the real executable
+        is run. Stubs, and the load code generated by the first run
+        (which sources profiles rather than replaying recordings),
+        are cached under $SSMUSE_CACHEDIR/shims. If the stubs
+        cannot be built, the domain is loaded normally.
 -f|+f <dirpath>
         Load generic/non-SSM directory tree.
 -h|--help
         Print help.
 -p|+p <pkgpath>
-        Load package.
+        Load package. Packages listed (comma separated) in the
+        Depends field of its .ssm.d/control file are loaded first,
+        transitively and each once, with lower precedence. Names
+        (e.g., <name>_<version>) are looked up in the domain of the
+        package, then as for -p.
+-p@|+p@ <pkgpath>
+        Load package lazily (see -d@).
+--platform <platform>
+        Generate code for the named platform (e.g., rhel-6.5-amd64-64)
+        rather than for this host, using its compatible platforms from
+        etc/ssmuse/platforms. Must come first (after --noeval). The
+        code can then be saved (e.g., ssmuse-sh --noeval --platform
+        <platform> ... > <file>) and sourced on hosts of that platform
+        without resolving there. Profile scripts are
+        sourced by the generated code, not replayed from recordings.
+--manifest <path>|@<path>
+        Load the items listed in a manifest file: options as above
+        (e.g., -d <dompath>), whitespace separated, with # comments.
+        All items are resolved in one pass. Parsed manifests are
+        cached (by mtime) under $SSMUSE_CACHEDIR/manifests.
+--nodeps
+        Do not load package dependencies (see -p).
 --noeval
         Do not evaluate. Useful for debugging.
+--view
+        Load subsequent items through a view: a cached symlink farm
+        (per platform, under $SSMUSE_CACHEDIR/views) merging their
+        bin, lib, include, man, etc. directories. Only the view
+        directories are added to the search paths; prepended and
+        appended items get separate views. Conflicts are
+        reported on stderr; the view is updated when a member
+        changes. Changes to SSMUSE_XINCDIRS/SSMUSE_XLIBDIRS made by
+        profiles of view members are not taken into account.
 
 Use leading - (e.g., -d) to prepend new paths, leading + to append
-new paths."""
+new paths.
+
+Profile scripts can be recorded: when $SSMUSE_RECORD_PROFILES is set
+(a :-separated list of path/name patterns, or "marked" for scripts
+with a "# ssmuse: record [inputs=VAR,...]" line), a matching script
+is run once in a subshell, with the environment set up to that
+point, and its changes to the environment are replayed by later
+loads instead of sourcing it. Recordings (under
+$SSMUSE_CACHEDIR/profiles) are redone when the script, platform,
+search path variables, or input variables (see also
+$SSMUSE_RECORD_INPUTS) differ. A script that fails, or follows one
+that is sourced, is sourced. Only environment variables are
+recorded, not shell functions or aliases.
+
+Filesystem probes are abandoned after $SSMUSE_PROBE_TIMEOUT seconds
+(default 10; 0 to disable): the mount is then treated as absent and
+skipped for $SSMUSE_PROBE_NEGTTL seconds (default 60). Files read by
+ssmuse (control files, manifests, profile scripts, cache entries) are
+read the same way. Not bounded: writes to the cache, and profile
+scripts run for recording or sourced by the generated code. The
+unresponsive mounts are remembered in the cache, so an unresponsive
+$SSMUSE_CACHEDIR (or $HOME) costs one timeout per run."""
 
 if __name__ == "__main__":
+    analyzing = False
     hostname = socket.gethostname()
     logger = None
     logpathprefixes = []
     nowst = time.strftime("%Y/%m/%dT%H:%M:%S", time.gmtime())
     platform0 = None
     selfpid = os.getpid()
+    targetplatform = None
+    # the environment as changed by the generated code
+    envmodel = AnalyzeCodeGenerator()
+    followdeps = True
+    loadedpkgpaths = set()
+    nsources = 0
+    prewarming = False
+    prewarmprocs = []
+    resolvecache = {}
     usetmp = False
+    viewmembers = None
+    viewsources = []
     verbose = os.environ.get("SSMUSE_VERBOSE")
 
     args = sys.argv[1:]
@@ -507,6 +2133,26 @@ if __name__ == "__main__":
         cg = ShCodeGenerator()
     elif shell == "csh":
         cg = CshCodeGenerator()
+    elif shell == "json":
+        # profile names follow sh
+        shell = "sh"
+        cg = JsonCodeGenerator()
+    elif shell == "prewarm":
+        # generated code is discarded
+        shell = "sh"
+        if args and args[0] == "--shell" and len(args) > 1:
+            args.pop(0)
+            shell = args.pop(0)
+        cg = JsonCodeGenerator()
+        prewarming = True
+    elif shell == "analyze":
+        # profile names follow sh
+        shell = "sh"
+        analyzing = True
+        asjson = args and args[0] == "--json"
+        if asjson:
+            args.pop(0)
+        cg = AnalyzeCodeGenerator(asjson)
     else:
         printe("fatal: bad shell type")
         sys.exit(1)
@@ -519,12 +2165,24 @@ if __name__ == "__main__":
         args.pop(0)
         usetmp = True
 
-    setuplogger()
+    if args and args[0] == "--platform":
+        args.pop(0)
+        if not args:
+            printe("fatal: missing platform")
+            sys.exit(1)
+        targetplatform = args.pop(0)
+
+    if not prewarming:
+        # prewarm must not count as usage
+        setuplogger()
 
     try:
         heredir = realpath(dirname(sys.argv[0]))
 
-        platforms = getplatforms()
+        platforms = getplatforms(targetplatform)
+        if targetplatform != None and targetplatform not in platforms:
+            printe("fatal: unknown platform (%s)" % (targetplatform,))
+            sys.exit(1)
         platform0 = platforms and platforms[0] or None
         revplatforms = platforms[::-1]
 
@@ -532,6 +2190,8 @@ if __name__ == "__main__":
 
         cg.comment("host (%s)" % (socket.gethostname(),))
         cg.comment("date (%s)" % (time.asctime(),))
+        if targetplatform != None:
+            cg.comment("target platform (%s)" % (targetplatform,))
         cg.comment("platforms (%s)" % (" ".join(platforms),))
         cg.comment("depnames (%s)" % (" ".join(depnames),))
         for name in ["SSMUSE_BASE", "SSMUSE_LOG", "SSMUSE_PATH",
@@ -539,49 +2199,15 @@ if __name__ == "__main__":
             value = os.environ.get(name, "-").replace("\n\t", "  ")
             cg.comment("env (%s) (%s)" % (name, value))
 
-        while args:
-            arg = args.pop(0)
-            if arg in ["-d", "+d"] and args:
-                pend = arg[0] == "-" and "prepend" or "append"
-                _dompath = args.pop(0)
-                cg.exportvar("SSMUSE_PENDMODE", pend)
-                _, dompath = augmentssmpath("domain", _dompath)
-                loaddomain(pend, dompath)
-                cg.ssmuseonchangeddeps(args)
-            elif arg in ["-f", "+f"] and args:
-                pend = arg[0] == "-" and "prepend" or "append"
-                _dirpath = args.pop(0)
-                cg.unexportvar("SSMUSE_PENDMODE")
-                _, dirpath = augmentssmpath("directory", _dirpath)
-                loaddirectory(pend, dirpath)
-            elif arg in ["-p", "+p"] and args:
-                pend = arg[0] == "-" and "prepend" or "append"
-                _pkgpath = args.pop(0)
-                cg.exportvar("SSMUSE_PENDMODE", pend)
-                _, pkgpath = augmentssmpath("package", _pkgpath)
-                loadpackage(pend, pkgpath)
-                cg.ssmuseonchangeddeps(args)
-            elif arg in ["-x", "+x"] and args:
-                _xpath = args.pop(0)
-                pathtype, xpath = augmentssmpath(None, _xpath)
-                if pathtype == "directory":
-                    args = [arg[0]+"f", _xpath]+args
-                elif pathtype == "domain":
-                    args = [arg[0]+"d", _xpath]+args
-                elif pathtype == "package":
-                    args = [arg[0]+"p", _xpath]+args
-            elif arg == "--append":
-                pend = "append"
-                cg.echo2err("pendmode: append")
-            elif arg == "--prepend":
-                pend = "prepend"
-                cg.echo2err("pendmode: prepend")
-            elif arg == "-v":
-                verbose = True
-            else:
-                printe("fatal: unknown argument (%s)" % (arg,))
-                sys.exit(1)
-        cg.unexportvar("SSMUSE_PENDMODE")
+        if prewarming:
+            prewarm(args)
+
+        args = expandmanifests(args)
+        prefetchitems(args)
+
+        loadargs(args)
+        loadview()
+        unexportvar("SSMUSE_PENDMODE")
 #       deduppaths()
 
         # prepare to write out (to stdout or tempfile)